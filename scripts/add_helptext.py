@@ -20,7 +20,9 @@ Command line documentation
 Added via `add_helptext.py`
 """
 
-if __name__ == "__main__":
+
+def generate():
+    """Return the current contents of the README, and the contents with updated CLI docs."""
     commands = [
         ["zcbor", "--help"],
         ["zcbor", "code", "--help"],
@@ -45,10 +47,20 @@ if __name__ == "__main__":
     with open(p_README, "r", encoding="utf-8") as f:
         readme_contents = f.read()
     new_readme_contents = sub(pattern + r".*", output, readme_contents, flags=S)
+    return readme_contents, new_readme_contents
+
+
+def check():
+    readme_contents, new_readme_contents = generate()
+    return new_readme_contents == readme_contents
+
+
+if __name__ == "__main__":
     if len(argv) > 1 and argv[1] == "--check":
-        if new_readme_contents != readme_contents:
+        if not check():
             print("Check failed")
             exit(9)
     else:
+        _, new_readme_contents = generate()
         with open(p_README, "w", encoding="utf-8") as f:
             f.write(new_readme_contents)
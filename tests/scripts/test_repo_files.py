@@ -6,16 +6,25 @@
 
 from unittest import TestCase, main, skipIf, SkipTest
 from pathlib import Path
-from re import search, S, compile
-from urllib import request
-from urllib.error import HTTPError
+from re import S, compile
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from click.testing import CliRunner
+import black
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from argparse import ArgumentParser
-from subprocess import Popen, check_output, PIPE, run
+from subprocess import check_output, PIPE, DEVNULL, run
 from shutil import rmtree, copy2
 from platform import python_version_tuple
-from sys import platform
-from threading import Thread
+from sys import platform, path as sys_path
+from threading import Lock, Semaphore
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import defaultdict
 from tempfile import mkdtemp
+from json import loads, dumps
+from functools import cache
+from time import time, monotonic, sleep
 import os
 
 
@@ -25,8 +34,7 @@ p_readme = p_root / "README.md"
 p_pypi_readme = p_root / "pypi_README.md"
 p_architecture = p_root / "ARCHITECTURE.md"
 p_release_notes = p_root / "RELEASE_NOTES.md"
-p_add_helptext = p_root / "scripts" / "add_helptext.py"
-p_regenerate_samples = p_root / "scripts" / "regenerate_samples.py"
+p_scripts = p_root / "scripts"
 p_hello_world_sample = p_root / "samples" / "hello_world"
 p_hello_world_build = p_hello_world_sample / "build"
 p_pet_sample = p_root / "samples" / "pet"
@@ -34,86 +42,236 @@ p_pet_cmake = p_pet_sample / "pet.cmake"
 p_pet_include = p_pet_sample / "include"
 p_pet_src = p_pet_sample / "src"
 p_pet_build = p_pet_sample / "build"
+p_build_stamp_name = "zcbor_test_build.stamp"
+p_sample_deps = [
+    p_root / "src",
+    p_root / "include",
+    p_root / "zcbor",
+    p_tests / "cases" / "pet.cddl",
+]
+p_link_cache = Path.home() / ".cache" / "zcbor-linkcheck.json"
+
+sys_path.insert(0, str(p_scripts))
+import add_helptext
+import regenerate_samples
+
+link_cache_ttl = 24 * 60 * 60  # Seconds before a cached link is revalidated.
+link_check_workers = min(32, (os.cpu_count() or 1) * 5)
+link_requests_per_host = 4  # Max simultaneous requests to the same host.
+link_request_interval = 0.1  # Min seconds between starting two requests (to avoid HTTP 429).
+link_timeout = 10  # Seconds
+link_max_backoff = 30  # Max seconds between retries of a link, when there is no Retry-After.
+
+version_regex = compile(r"\A\d+")
+link_regex = compile(r"\[.*?\]\((?P<link>.*?)\)")
+sample_readme_regex = compile(
+    r"### To build:.*?```(?P<to_build>.*?)```"
+    r"|### To run:.*?```(?P<to_run>.*?)```"
+    r"|### Expected output:.*?(?P<exp_out>(\n>[^\n]*)+)",
+    flags=S,
+)
+
+
+def git(*args):
+    """Run git in the repo, and return its output, or None if it fails."""
+    result = run(["git", *args], capture_output=True, cwd=p_root)
+    return result.stdout.decode("utf-8").strip() if result.returncode == 0 else None
+
+
+@cache
+def changed_files():
+    """Return the set of files changed (including deleted) compared to the branch to merge into.
+
+    The branch is taken from ZCBOR_BASE_REF or GITHUB_BASE_REF (set in pull requests). It is
+    fetched from origin if not present locally. Return None if there is no such branch, or git
+    fails to compare with it."""
+    base_ref = os.environ.get("ZCBOR_BASE_REF") or os.environ.get("GITHUB_BASE_REF")
+    if not base_ref:
+        return None
+    refs = (f"origin/{base_ref}", base_ref)
+    local = [r for r in refs if git("rev-parse", "--verify", "--quiet", r + "^{commit}")]
+    target = local[0] if local else refs[0]
+    if not local:
+        fetch_args = ["fetch", "origin", f"{base_ref}:refs/remotes/{target}"]
+        if git("rev-parse", "--is-shallow-repository") == "true":
+            # E.g. a CI checkout. Only the trees are needed to find the changed files, so don't
+            # fetch any history or blobs, unless the server doesn't support partial clones.
+            # This is not done in full clones, since it would make them shallow.
+            shallow_args = fetch_args + ["--depth=1"]
+            if git(*shallow_args, "--filter=blob:none") is None and git(*shallow_args) is None:
+                return None
+        elif git(*fetch_args) is None:
+            return None
+    # In a shallow clone, there might not be a merge base, so compare with the target directly.
+    # --no-renames lists the old path of renamed files too, so they are seen as deleted.
+    merge_base = git("merge-base", target, "HEAD") or target
+    diff = git("diff", "--name-only", "--no-renames", merge_base)
+    if diff is None:
+        return None
+    return frozenset(p_root / f for f in diff.split("\n") if f)
+
+
+def changed_py_files():
+    """Return the existing Python files in changed_files(), or None."""
+    changed = changed_files()
+    if changed is None:
+        return None
+    return sorted(f for f in changed if f.suffix == ".py" and f.exists())
 
 
 class TestCodestyle(TestCase):
     def test_codestyle(self):
-        black_res = Popen(["black", "--check", p_root, "-l", "100"], stdout=PIPE, stderr=PIPE)
-        _, stderr = black_res.communicate()
-        self.assertEqual(0, black_res.returncode, "black failed:\n" + stderr.decode("utf-8"))
+        """Check formatting of the Python files changed in this branch.
+
+        All files are checked if no Python files changed (black or its config might have), or if
+        the changed files are unknown."""
+        changed = changed_py_files()
+        black_args = ["--check", "-l", "100"] + [str(p) for p in (changed or [p_root])]
+        # Let black crash with a traceback, instead of failing with an empty message.
+        black_res = CliRunner().invoke(black.main, black_args, catch_exceptions=False)
+        self.assertEqual(0, black_res.exit_code, "black failed:\n" + black_res.output)
 
 
 def version_int(in_str):
-    return int(search(r"\A\d+", in_str)[0])  # e.g. '0rc' -> '0'
+    return int(version_regex.search(in_str)[0])  # e.g. '0rc' -> '0'
+
+
+def newest_mtime(paths, exclude):
+    """Return the newest modification time of any file in paths (recursively), except in exclude."""
+    files = [f for p in paths for f in ([p] if p.is_file() else p.rglob("*")) if f.is_file()]
+    return max(f.stat().st_mtime for f in files if exclude not in f.parents)
+
+
+def canonical_link(link):
+    """Normalize a URL so that different spellings of the same resource compare equal.
+
+    The fragment is dropped, since it doesn't affect whether the resource exists."""
+    scheme, netloc, path, query, _ = urlsplit(link)
+    scheme, netloc = scheme.lower(), netloc.lower()
+    default_port = {"http": ":80", "https": ":443"}.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[: -len(default_port)]
+    query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def link_session():
+    """Create a session that reuses connections to the same host across link checks."""
+    session = Session()
+    # When retrying 429 and 503, wait as long as the Retry-After header says, if present.
+    # Otherwise, back off exponentially with jitter, so the threads don't retry in lockstep.
+    retry = Retry(
+        total=3,
+        backoff_factor=1,
+        backoff_jitter=1,
+        backoff_max=link_max_backoff,
+        respect_retry_after_header=True,
+        status_forcelist=[429, 502, 503],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=link_check_workers, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def request_link(session, link, headers, method):
+    """Send a request to the URL link and return the status code and response headers.
+
+    The body is not downloaded."""
+    if method == "HEAD":
+        # There is no body, so the connection is returned to the session's pool for reuse.
+        r = session.request(method, link, headers=headers, timeout=link_timeout)
+        return r.status_code, r.headers
+    # Closing the response without reading the body also closes the connection.
+    with session.request(method, link, headers=headers, timeout=link_timeout, stream=True) as r:
+        return r.status_code, r.headers
+
+
+def cmake_build_run_worker(path, build_path):
+    """Build and run a sample in a worker process. Assertion errors are raised in the caller."""
+    TestSamples().cmake_build_run(path, build_path)
 
 
 class TestSamples(TestCase):
-    def popen_test(self, args, input="", exp_retcode=0, **kwargs):
-        call0 = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, **kwargs)
-        stdout0, stderr0 = call0.communicate(input)
-        self.assertEqual(exp_retcode, call0.returncode, stderr0.decode("utf-8"))
-        return stdout0, stderr0
+    def run_check(self, args, exp_retcode=0, **kwargs):
+        """Run a command and check its return code, discarding its stdout."""
+        call0 = run(args, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, **kwargs)
+        self.assertEqual(exp_retcode, call0.returncode, call0.stderr.decode("utf-8"))
+
+    def run_capture(self, args, input=b"", exp_retcode=0, **kwargs):
+        """Run a command, check its return code, and return its stdout and stderr."""
+        call0 = run(args, input=input, capture_output=True, **kwargs)
+        self.assertEqual(exp_retcode, call0.returncode, call0.stderr.decode("utf-8"))
+        return call0.stdout, call0.stderr
+
+    def build_is_up_to_date(self, path, build_path):
+        """Whether a previous build of the sample at path succeeded after its sources last changed.
+
+        Set ZCBOR_FORCE_REBUILD to always rebuild."""
+        stamp = build_path / p_build_stamp_name
+        if "ZCBOR_FORCE_REBUILD" in os.environ or not stamp.exists():
+            return False
+        return stamp.stat().st_mtime > newest_mtime([path] + p_sample_deps, exclude=build_path)
 
     def cmake_build_run(self, path, build_path):
-        if build_path.exists():
+        up_to_date = self.build_is_up_to_date(path, build_path)
+        if build_path.exists() and not up_to_date:
             rmtree(build_path)
-        with open(path / "README.md", "r", encoding="utf-8") as f:
-            contents = f.read()
+        contents = (path / "README.md").read_text(encoding="utf-8")
 
-        to_build_patt = r"### To build:.*?```(?P<to_build>.*?)```"
-        to_run_patt = r"### To run:.*?```(?P<to_run>.*?)```"
-        exp_out_patt = r"### Expected output:.*?(?P<exp_out>(\n>[^\n]*)+)"
-        to_build = search(to_build_patt, contents, flags=S)["to_build"].strip()
-        to_run = search(to_run_patt, contents, flags=S)["to_run"].strip()
-        exp_out = search(exp_out_patt, contents, flags=S)["exp_out"].replace("\n> ", "\n").strip()
+        sections = dict()
+        for m in sample_readme_regex.finditer(contents):
+            for name, section in m.groupdict().items():
+                if section is not None:
+                    sections.setdefault(name, section)
+        to_build = sections["to_build"].strip()
+        to_run = sections["to_run"].strip()
+        exp_out = sections["exp_out"].replace("\n> ", "\n").strip()
 
-        os.chdir(path)
         commands_build = [(line.split(" ")) for line in to_build.split("\n")]
         assert "\n" not in to_run, "The 'to run' section should only have one command."
         commands_run = to_run.split(" ")
-        for c in commands_build:
-            self.popen_test(c)
+        if not up_to_date:
+            for c in commands_build:
+                self.run_check(c, cwd=path)
+            (build_path / p_build_stamp_name).touch()
         output_run = ""
         for c in commands_run:
-            output, _ = self.popen_test(c)
+            output, _ = self.run_capture(c, cwd=path)
             output_run += output.decode("utf-8")
         self.assertEqual(exp_out, output_run.strip())
 
     @skipIf(platform.startswith("win"), "Skip on Windows because requires a Unix shell.")
-    def test_hello_world(self):
-        output = self.cmake_build_run(p_hello_world_sample, p_hello_world_build)
-
-    @skipIf(platform.startswith("win"), "Skip on Windows because requires a Unix shell.")
-    def test_pet(self):
-        output = self.cmake_build_run(p_pet_sample, p_pet_build)
+    def test_samples(self):
+        """Build and run the hello_world and pet samples in parallel."""
+        samples = [(p_hello_world_sample, p_hello_world_build), (p_pet_sample, p_pet_build)]
+        with ProcessPoolExecutor(max_workers=len(samples)) as executor:
+            runs = [(p, executor.submit(cmake_build_run_worker, p, b)) for p, b in samples]
+            for path, sample_run in runs:
+                with self.subTest(sample=path.name):
+                    sample_run.result()
 
     def test_pet_regenerate(self):
         """Check the zcbor-generated code for the "pet" sample"""
-        regenerate = Popen(["python3", p_regenerate_samples, "--check"])
-        regenerate.communicate()
-        self.assertEqual(0, regenerate.returncode)
+        self.assertTrue(regenerate_samples.check(), "The generated code is not up to date.")
 
     def test_pet_file_header(self):
         files = list(p_pet_include.iterdir()) + list(p_pet_src.iterdir()) + [p_pet_cmake]
         for p in [f for f in files if "pet" in f.name]:
-            with p.open("r", encoding="utf-8") as f:
-                f.readline()  # discard
-                self.assertEqual(
-                    f.readline().strip(" *#\n"),
-                    "Copyright (c) 2022 Nordic Semiconductor ASA",
-                )
-                f.readline()  # discard
-                self.assertEqual(f.readline().strip(" *#\n"), "SPDX-License-Identifier: Apache-2.0")
-                f.readline()  # discard
-                self.assertIn("Generated using zcbor version", f.readline())
-                self.assertIn("https://github.com/NordicSemiconductor/zcbor", f.readline())
-                self.assertIn("Generated with a --default-max-qty of", f.readline())
+            with p.open("rb") as f:
+                lines = f.read(1024).decode("utf-8").splitlines()  # The header is much shorter.
+            self.assertEqual(lines[1].strip(" *#"), "Copyright (c) 2022 Nordic Semiconductor ASA")
+            self.assertEqual(lines[3].strip(" *#"), "SPDX-License-Identifier: Apache-2.0")
+            self.assertIn("Generated using zcbor version", lines[5])
+            self.assertIn("https://github.com/NordicSemiconductor/zcbor", lines[6])
+            self.assertIn("Generated with a --default-max-qty of", lines[7])
 
 
 class TestDocs(TestCase):
-    def __init__(self, *args, **kwargs):
-        """Overridden to get base URL for relative links from remote tracking branch."""
-        super(TestDocs, self).__init__(*args, **kwargs)
+    @classmethod
+    def set_base_url(cls):
+        """Get base URL for relative links from remote tracking branch."""
         remote_tr_args = [
             "git",
             "rev-parse",
@@ -128,34 +286,109 @@ class TestDocs(TestCase):
             repo_url_args = ["git", "remote", "get-url", remote]
             repo_url = check_output(repo_url_args).decode("utf-8").strip().strip(".git")
             if "github.com" in repo_url:
-                self.base_url = repo_url + "/tree/" + remote_branch + "/"
+                cls.base_url = repo_url + "/tree/" + remote_branch + "/"
             else:
                 # The URL is not in github.com, so we are not sure it is constructed correctly.
-                self.base_url = None
+                cls.base_url = None
         elif "GITHUB_SHA" in os.environ and "GITHUB_REPOSITORY" in os.environ:
             repo = os.environ["GITHUB_REPOSITORY"]
             sha = os.environ["GITHUB_SHA"]
-            self.base_url = f"https://github.com/{repo}/blob/{sha}/"
+            cls.base_url = f"https://github.com/{repo}/blob/{sha}/"
         else:
             # There is no remote tracking branch.
-            self.base_url = None
-
-        self.link_regex = compile(r"\[.*?\]\((?P<link>.*?)\)")
-
-    def check_code(self, link, codes):
-        """Check the status code of a URL link. Assert if not 200 (OK)."""
-        try:
-            call = request.urlopen(link)
-            code = call.getcode()
-        except HTTPError as e:
-            code = e.code
-        codes.append((link, code))
+            cls.base_url = None
+
+    @classmethod
+    def setUpClass(cls):
+        """Find the base URL (once, since it requires calling git), and load the on-disk cache of
+        previously checked links.
+
+        Set ZCBOR_LINKCHECK_NOCACHE to ignore the cache and check all links over the network."""
+        if not hasattr(cls, "base_url"):
+            cls.set_base_url()
+        cls.use_link_cache = "ZCBOR_LINKCHECK_NOCACHE" not in os.environ
+        cls.link_cache = dict()
+        cls.link_cache_updated = False
+        cls.link_cache_lock = Lock()
+        if cls.use_link_cache and p_link_cache.exists():
+            try:
+                cls.link_cache = loads(p_link_cache.read_text(encoding="utf-8"))
+            except ValueError:
+                pass  # Corrupt cache, start over.
+        cls.host_semaphores = defaultdict(lambda: Semaphore(link_requests_per_host))
+        cls.request_gate_lock = Lock()
+        cls.next_request_time = monotonic()
+        cls.session = link_session()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+        if cls.use_link_cache and cls.link_cache_updated:
+            p_link_cache.parent.mkdir(parents=True, exist_ok=True)
+            p_link_cache.write_text(dumps(cls.link_cache, indent=2), encoding="utf-8")
+
+    def wait_for_request_slot(self, link):
+        """Rate limit requests, and return the semaphore limiting requests to the link's host."""
+        with self.request_gate_lock:
+            now = monotonic()
+            wait = self.next_request_time - now
+            # Set on the class, so the rate limit holds across tests.
+            type(self).next_request_time = max(now, self.next_request_time) + link_request_interval
+            semaphore = self.host_semaphores[urlsplit(link).netloc]
+        if wait > 0:
+            sleep(wait)
+        return semaphore
+
+    def check_code(self, canonical, link):
+        """Return the status code of a URL link. canonical is used as the key in the cache.
+
+        Links that were OK less than link_cache_ttl ago are not checked again. Older cache entries
+        are revalidated with a conditional request, where 304 (Not Modified) counts as OK.
+        Links to files in this repo are not cached, since the branch they point to can change."""
+        in_repo = self.base_url is not None and link.startswith(self.base_url)
+        use_cache = self.use_link_cache and not in_repo
+        cached = self.link_cache.get(canonical) if use_cache else None
+        if cached and time() - cached["timestamp"] < link_cache_ttl:
+            return cached["code"]
+
+        headers = {"User-Agent": "zcbor-linkcheck"}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+        with self.wait_for_request_slot(link):
+            # Use HEAD to avoid downloading the page.
+            code, response_headers = request_link(self.session, link, headers, "HEAD")
+            if code in (403, 405, 501):
+                # The server might not support HEAD, so try again with GET.
+                code, response_headers = request_link(self.session, link, headers, "GET")
+
+        if code == 304:
+            code = 200
+        if code == 200 and use_cache:
+            with self.link_cache_lock:
+                type(self).link_cache_updated = True  # Read in tearDownClass().
+                self.link_cache[canonical] = {
+                    "code": code,
+                    "etag": response_headers.get("ETag", cached and cached["etag"]),
+                    "last_modified": response_headers.get(
+                        "Last-Modified", cached and cached["last_modified"]
+                    ),
+                    "timestamp": time(),
+                }
+        return code
 
     def do_test_links(self, path, allow_local=True):
         """Get all Markdown links in the file at <path> and check that they work."""
         if allow_local and self.base_url is None:
             raise SkipTest("This test requires the current branch to be pushed to Github.")
 
+        changed = changed_files()
+        if changed is not None and path not in changed and all(f.exists() for f in changed):
+            # Links in unchanged docs are checked when the test is run without a base branch.
+            # Deleted files can break links to them, so then all docs are checked.
+            raise SkipTest(f"{path.name} has not changed.")
+
         text = path.read_text(encoding="utf-8")
 
         if allow_local:
@@ -163,9 +396,8 @@ class TestDocs(TestCase):
             relative_path = str(path.relative_to(p_root).parent)
             relative_path = "" if relative_path == "." else relative_path + "/"
 
-        matches = self.link_regex.findall(text)
-        codes = list()
-        threads = list()
+        matches = link_regex.findall(text)
+        links = dict()  # Canonical link -> link as written (which is the one requested).
         for m in matches:
             link = m
             if allow_local:
@@ -176,10 +408,11 @@ class TestDocs(TestCase):
                     link = self.base_url + relative_path + link
             else:
                 self.assertTrue(link.startswith("https://"), "Link is not a URL")
-            threads.append(t := Thread(target=self.check_code, args=(link, codes), daemon=True))
-            t.start()
-        for t in threads:
-            t.join()
+            links.setdefault(canonical_link(link), link)
+        if not links:
+            return
+        with ThreadPoolExecutor(max_workers=link_check_workers) as executor:
+            codes = list(zip(links.values(), executor.map(self.check_code, links, links.values())))
         for link, code in codes:
             self.assertEqual(code, 200, f"'{link}' gives code {code}")
 
@@ -208,9 +441,7 @@ class TestDocs(TestCase):
     @skipIf(platform.startswith("win"), "Skip on Windows because of path/newline issues.")
     def test_cli_doc(self):
         """Check the auto-generated CLI docs in the top level README.md file."""
-        add_help = Popen(["python3", p_add_helptext, "--check"])
-        add_help.communicate()
-        self.assertEqual(0, add_help.returncode)
+        self.assertTrue(add_helptext.check(), "The CLI docs in README.md are not up to date.")
 
 
 if __name__ == "__main__":